@@ -4,6 +4,8 @@ set -eu
 # defaults
 : "${CRON:=}"
 : "${RUN_ON_START:=false}"
+: "${LOOP:=false}"
+: "${WATCH:=false}"
 
 APP_CMD="python -u /app/unifi_adguard_client_sync.py"
 
@@ -19,6 +21,20 @@ log() {
   echo "[entrypoint] $1"
 }
 
+# if WATCH=true or LOOP=true, the app keeps running and schedules its own syncs; cron is not needed
+case "${WATCH}" in
+  true|"true"|1)
+    log "Watching Unifi for client events..."
+    exec sh -lc "${APP_CMD}"
+    ;;
+esac
+case "${LOOP}" in
+  true|"true"|1)
+    log "Syncing every ${SYNC_INTERVAL:-300}s..."
+    exec sh -lc "${APP_CMD}"
+    ;;
+esac
+
 # if RUN_ON_START=true, run one sync immediately
 case "${RUN_ON_START}" in
   true|"true"|1)
@@ -48,6 +64,10 @@ ADGUARD_URL=${ADGUARD_URL:-}
 ADGUARD_USERNAME=${ADGUARD_USERNAME:-}
 ADGUARD_PW=${ADGUARD_PW:-}
 IGNORED_NETWORKS=${IGNORED_NETWORKS:-}
+ALLOWED_OUIS=${ALLOWED_OUIS:-}
+PRUNE=${PRUNE:-}
+LOG_LEVEL=${LOG_LEVEL:-}
+STATE_FILE=${STATE_FILE:-}
 PYTHONUNBUFFERED=${PYTHONUNBUFFERED:-1}
 PYTHONDONTWRITEBYTECODE=${PYTHONDONTWRITEBYTECODE:-1}
 
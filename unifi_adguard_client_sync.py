@@ -7,27 +7,101 @@ Usage:
     unifi_adguard_client_sync.py \
         --unifi-url URL --unifi-username USER [--unifi-password PW] \
         --adguard-url URL --adguard-username USER [--adguard-password PW] \
-        [--ignored-networks NET1 NET2]
+        [--ignored-networks NET1 NET2] [--allowed-ouis OUI1,OUI2] [--prune] [--state-file PATH] [--loop | --watch] [--interval SECONDS]
 
 Passwords:
     You may supply passwords either via optional CLI flags or environment variables. If a flag is omitted,
     the script will look for UNIFI_PW / ADGUARD_PW. If neither a flag nor environment variable is present,
     the script exits with an error.
+
+Loop and watch modes:
+    With --loop (or LOOP=true) the script keeps running and syncs every --interval seconds (or SYNC_INTERVAL,
+    default 300). With --watch (or WATCH=true) it keeps running, subscribes to the Unifi event websocket and
+    syncs whenever clients connect, disconnect or change; while the websocket is down it falls back to
+    polling every --interval seconds.
 """
 __author__ = "PleaseStopAsking"
 __maintainer__ = "PleaseStopAsking"
 __version__ = "1.0.0"
 
 import os
+import sys
+import re
+import ssl
+import asyncio
+import hashlib
+import logging
+import logging.handlers
 from datetime import timezone, datetime
-import requests
-import argparse
-from urllib3.exceptions import InsecureRequestWarning
-import urllib3
-urllib3.disable_warnings(InsecureRequestWarning)
+import aiohttp
+import ijson
+import orjson
+from types import SimpleNamespace
 
+log = logging.getLogger("sync")
+watch_log = logging.getLogger("watch")
 
-def parse_args():
+# AdGuard client ids mix IPs, CIDRs, client-ids and MACs; match only colon-separated MACs
+_is_mac = re.compile(r'^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$').match
+
+# Unifi websocket messages that signal a client was added, removed or changed
+UNIFI_SYNC_EVENTS = frozenset({"sta:sync", "user:sync", "client:sync"})
+# seconds to wait after an event so a burst of events results in a single sync
+SYNC_DEBOUNCE = 2
+# --prune refuses to delete more than this fraction of the AdGuard clients that have a MAC in one cycle
+PRUNE_MAX_FRACTION = 0.5
+
+# certificate verification is disabled; one context is shared by every connection so TLS sessions can be resumed
+_SSL_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+_SSL_CONTEXT.check_hostname = False
+_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# the only Unifi client fields used downstream; everything else is dropped while streaming
+_UNIFI_FIELDS = ("mac", "name", "network_name", "fixed_ip", "ip", "display_name")
+
+# constant parts of the AdGuard client payloads; per-client "name" and "ids" are merged in.
+# They are never mutated, only serialized, so the nested lists can be shared
+_ADD_TMPL = {
+    "use_global_settings": True,
+    # "filtering_enabled": True,
+    # "parental_enabled": True,
+    # "safebrowsing_enabled": True,
+    # "safe_search": {
+    #    "enabled": True,
+    #    "bing": True,
+    #    "duckduckgo": True,
+    #    "ecosia": True,
+    #    "google": True,
+    #    "pixabay": True,
+    #    "yandex": True,
+    #    "youtube": True
+    # },
+    "use_global_blocked_services": True,
+    "tags": [],
+}
+_UPDATE_INNER_TMPL = {
+    "upstreams": [],
+    "tags": [],
+    "blocked_services": None,
+    "filtering_enabled": False,
+    "parental_enabled": False,
+    "safebrowsing_enabled": False,
+    "safesearch_enabled": False,
+    "use_global_blocked_services": True,
+    "use_global_settings": True
+}
+
+# last AdGuard client list, reused while the server reports (ETag) or returns (body hash) the same data
+_adguard_cache = {"etag": None, "body_hash": None, "clients": None}
+
+# the container passes everything via environment; argparse is only imported when flags are given
+_ENV_ONLY = not sys.argv[1:]
+_ARG_DESTS = ("unifi_url", "unifi_username", "unifi_password", "adguard_url", "adguard_username",
+              "adguard_password", "ignored_networks", "allowed_ouis", "prune", "state_file", "loop", "watch", "interval")
+
+
+def _parse_cli_args():
+    import argparse
     parser = argparse.ArgumentParser(
         description=("Sync active client data in Unifi OS with client records in AdGuard. "
                      "Passwords can be provided via flags or environment variables (UNIFI_PW, ADGUARD_PW)."))
@@ -41,7 +115,27 @@ def parse_args():
     parser.add_argument("--adguard-password", dest="adguard_password", required=False, help="AdGuard password (or set ADGUARD_PW)")
     parser.add_argument("--ignored-networks", dest="ignored_networks", required=False,
                         help="Comma-delimited list of network names to ignore (e.g., 'Guest,IoT')")
-    args = parser.parse_args()
+    parser.add_argument("--allowed-ouis", dest="allowed_ouis", required=False,
+                        help="Comma-delimited list of vendor OUIs to sync; all others are skipped (e.g., 'AA:BB:CC,001122')")
+    parser.add_argument("--prune", dest="prune", action="store_true", default=None,
+                        help="Delete AdGuard clients whose MAC is not an active Unifi client (or set PRUNE=true)")
+    parser.add_argument("--state-file", dest="state_file", required=False,
+                        help="File used to remember the last synced Unifi snapshot (or set STATE_FILE)")
+    parser.add_argument("--loop", dest="loop", action="store_true", default=None,
+                        help="Keep running and sync every --interval seconds (or set LOOP=true)")
+    parser.add_argument("--watch", dest="watch", action="store_true", default=None,
+                        help="Keep running and sync on Unifi client events (or set WATCH=true)")
+    parser.add_argument("--interval", dest="interval", type=int, required=False,
+                        help=("Seconds between syncs with --loop, or between polls while the Unifi event stream "
+                              "is down with --watch (or set SYNC_INTERVAL)"))
+    return parser.parse_args()
+
+
+def parse_args():
+    if _ENV_ONLY:
+        args = SimpleNamespace(**dict.fromkeys(_ARG_DESTS))
+    else:
+        args = _parse_cli_args()
 
     # fallback to environment variables if flags not supplied
     # allow using environment for all connection parameters
@@ -59,9 +153,31 @@ def parse_args():
         args.adguard_password = os.environ.get("ADGUARD_PW")
     if args.ignored_networks is None:
         args.ignored_networks = os.environ.get("IGNORED_NETWORKS", "")
-    # convert comma-delimited string to list, trimming whitespace; support empty -> []
+    if args.allowed_ouis is None:
+        args.allowed_ouis = os.environ.get("ALLOWED_OUIS", "")
+    if args.prune is None:
+        args.prune = os.environ.get("PRUNE", "false").strip().lower() in ("true", "1")
+    if args.state_file is None:
+        args.state_file = os.environ.get("STATE_FILE") or "~/.cache/adguard-sync/state.json"
+    args.state_file = os.path.expanduser(args.state_file)
+    if args.loop is None:
+        args.loop = os.environ.get("LOOP", "false").strip().lower() in ("true", "1")
+    if args.watch is None:
+        args.watch = os.environ.get("WATCH", "false").strip().lower() in ("true", "1")
+    if args.interval is None:
+        try:
+            args.interval = int(os.environ.get("SYNC_INTERVAL", "300"))
+        except ValueError:
+            raise SystemExit("SYNC_INTERVAL must be a whole number of seconds")
+    # convert comma-delimited string to a set, trimming whitespace; support empty -> frozenset()
     if isinstance(args.ignored_networks, str):
         args.ignored_networks = [n.strip() for n in args.ignored_networks.split(",") if n.strip()]
+    args.ignored_networks = frozenset(args.ignored_networks)
+    # normalize OUIs to 6 lowercase hex digits, the same form mac_oui() produces; empty -> no filter
+    args.allowed_ouis = frozenset(re.sub(r"[:\-. ]", "", o).lower() for o in args.allowed_ouis.split(",") if o.strip())
+    for oui in args.allowed_ouis:
+        if not re.fullmatch(r"[0-9a-f]{6}", oui):
+            raise SystemExit(f"Invalid OUI '{oui}': check --allowed-ouis or ALLOWED_OUIS")
 
     # validate presence for all required fields
     if not args.unifi_url:
@@ -76,236 +192,534 @@ def parse_args():
         raise SystemExit("AdGuard username missing: supply --adguard-username or set ADGUARD_USERNAME")
     if not args.adguard_password:
         raise SystemExit("AdGuard password missing: supply --adguard-password or set ADGUARD_PW")
+    if args.interval <= 0:
+        raise SystemExit("Interval must be positive: check --interval or SYNC_INTERVAL")
+
+    # build every endpoint url once
+    args.urls = SimpleNamespace(
+        unifi_login=f"{args.unifi_url}/api/auth/login",
+        unifi_clients=f"{args.unifi_url}/proxy/network/v2/api/site/default/clients/active",
+        unifi_events=f"{args.unifi_url}/proxy/network/wss/s/default/events",
+        adguard_login=f"{args.adguard_url}/control/login",
+        adguard_clients=f"{args.adguard_url}/control/clients",
+        adguard_add=f"{args.adguard_url}/control/clients/add",
+        adguard_update=f"{args.adguard_url}/control/clients/update",
+        adguard_delete=f"{args.adguard_url}/control/clients/delete",
+    )
     return args
 
 
-def unifi_login(s: requests.Session, arguments):
+def setup_logging():
+    """
+    Log to stdout at LOG_LEVEL (default INFO). Records are buffered and written together
+    when flush_logs() is called at the end of a cycle, or immediately for warnings and errors.
+    :return: None
+    """
+    level = (os.environ.get("LOG_LEVEL") or "INFO").strip().upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise SystemExit(f"Invalid LOG_LEVEL '{level}': use DEBUG, INFO, WARNING or ERROR")
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+    buffered = logging.handlers.MemoryHandler(capacity=1000, flushLevel=logging.WARNING, target=stream)
+    logging.basicConfig(handlers=[buffered])
+    # only this script's loggers follow LOG_LEVEL; libraries keep the default WARNING
+    log.setLevel(level)
+    watch_log.setLevel(level)
+
+
+def flush_logs():
+    """
+    Write out any buffered log records.
+    :return: None
+    """
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
+def client_session() -> aiohttp.ClientSession:
+    """
+    Build the shared HTTP session. Connections to each host are pooled and kept alive
+    across calls, and JSON headers are set once instead of per request.
+    The cookie jar is "unsafe" so login cookies from IP-addressed hosts are kept.
+    :return: aiohttp.ClientSession
+    """
+    connector = aiohttp.TCPConnector(ssl=_SSL_CONTEXT, limit=32, limit_per_host=16, keepalive_timeout=30)
+    return aiohttp.ClientSession(connector=connector,
+                                 cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                 headers={"Accept": "application/json", "Content-Type": "application/json"})
+
+
+def _post(s: aiohttp.ClientSession, url, payload):
+    """
+    POST a JSON payload encoded with orjson. The session already sends the JSON Content-Type.
+    :param s:       aiohttp.ClientSession
+    :param url:     full request url
+    :param payload: JSON-serializable object
+    :return:        request context manager (use with `async with`)
+    """
+    return s.post(url, data=orjson.dumps(payload))
+
+
+async def unifi_login(s: aiohttp.ClientSession, arguments):
     """
     Simple POST request to log in. This will store a cookie in the session cookie jar.
     :param arguments: argparse arguments
-    :param s: requests.Session
+    :param s: aiohttp.ClientSession
     :return: None
     """
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
     data = {
         "username": arguments.unifi_username,
         "password": arguments.unifi_password
     }
-    r = s.post("{}/api/auth/login".format(arguments.unifi_url), headers=headers, json=data, verify=False)
-    r.raise_for_status()
+    async with _post(s, arguments.urls.unifi_login, data) as r:
+        r.raise_for_status()
 
 
-def unifi_get_active_clients(s: requests.Session, arguments):
+def mac_oui(mac: str) -> str:
+    """
+    Vendor prefix (first three octets) of a MAC as 6 lowercase hex digits.
+    :param mac: mac address, e.g. 'AA:BB:CC:DD:EE:FF'
+    :return:    str, e.g. 'aabbcc'
     """
-    Simple GET request to retrieve all Active clients from Unifi.
+    return mac[:8].replace(':', '').lower()
+
+
+async def unifi_get_active_clients(s: aiohttp.ClientSession, arguments):
+    """
+    Simple GET request to retrieve all Active clients from Unifi. Clients on ignored networks,
+    or outside the allowed OUIs when any are configured, are left out.
+    The response is stream-decoded and only the _UNIFI_FIELDS of each client are kept.
+    Anything but a top-level JSON array (e.g. an error envelope) raises ValueError rather
+    than reading as "no active clients".
     :param arguments: argparse arguments
-    :param s: requests.Session
+    :param s: aiohttp.ClientSession
     :return: dict[str, dict] -> {mac_addr: client-obj}
     """
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
-    clients = s.get("{}/proxy/network/v2/api/site/default/clients/active".format(arguments.unifi_url), headers=headers, verify=False)
-    clients.raise_for_status()
-    c = clients.json()
+    ignored = arguments.ignored_networks
+    allowed = arguments.allowed_ouis
     active_clients = dict()
-    for client in c:
-        if client.get('network_name') not in arguments.ignored_networks:
-            active_clients[client['mac']] = client
+    found = ijson.sendable_list()
+    parser = ijson.items_coro(found, 'item', use_float=True)
+
+    def collect():
+        for client in found:
+            if 'mac' in client and client.get('network_name') not in ignored \
+                    and (not allowed or mac_oui(client['mac']) in allowed):
+                active_clients[client['mac']] = {k: client.get(k) for k in _UNIFI_FIELDS}
+        del found[:]
+
+    head = b""
+    async with s.get(arguments.urls.unifi_clients) as clients:
+        clients.raise_for_status()
+        async for chunk in clients.content.iter_chunked(65536):
+            if not head:
+                head = chunk.lstrip()[:1]
+                if head and head != b"[":
+                    raise ValueError("Unexpected Unifi clients response: expected a JSON array")
+            parser.send(chunk)
+            collect()
+    if head != b"[":
+        raise ValueError("Unexpected Unifi clients response: empty body")
+    parser.close()
+    collect()
     return active_clients
 
 
-def adguard_login(s: requests.Session, arguments):
+async def unifi_event_stream(s: aiohttp.ClientSession, arguments):
+    """
+    Subscribe to the Unifi Network event websocket and yield each decoded message.
+    Frames that are not JSON objects are skipped. The session must already be logged in.
+    Returns when the websocket closes.
+    :param s:         aiohttp.ClientSession
+    :param arguments: argparse arguments
+    :return:          async iterator of dict
+    """
+    async with s.ws_connect(arguments.urls.unifi_events, heartbeat=30) as ws:
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    event = orjson.loads(msg.data)
+                except orjson.JSONDecodeError:
+                    continue
+                if isinstance(event, dict):
+                    yield event
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                break
+
+
+async def adguard_login(s: aiohttp.ClientSession, arguments):
     """
     Simple POST request to log in to Adguard with username and password. Adds cookie
     to session cookie jar.
     :param arguments: argparse arguments
-    :param s: requests.Session
+    :param s: aiohttp.ClientSession
     :return: None
     """
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
     data = {
         "name": arguments.adguard_username,
         "password": arguments.adguard_password
     }
-    r = s.post("{}/control/login".format(arguments.adguard_url), headers=headers, json=data)
-    r.raise_for_status()
+    async with _post(s, arguments.urls.adguard_login, data) as r:
+        r.raise_for_status()
 
 
-def adguard_get_clients(s: requests.Session, arguments) -> dict[str, dict]:
+async def adguard_get_clients(s: aiohttp.ClientSession, arguments) -> dict[str, dict]:
     """
     GET Request to retrieve all clients from Adguard. They are then organized
     in a dictionary where the mac-address is a key. If they do not have a
     mac-address, they are ignored. TODO: Should they be?
-    :param s:   requests.Session
+    Each stored client also carries '_ids_set', a frozenset of its ids for diffing.
+    The parsed result is cached in _adguard_cache and returned as-is when the server
+    answers 304 to If-None-Match, or when the response body is byte-for-byte unchanged.
+    :param s:   aiohttp.ClientSession
     :param arguments: argparse arguments
     :return:    dict[str, dict] -> {mac_addr: client-obj}
     """
-    r = s.get("{}/control/clients".format(arguments.adguard_url))
-    r.raise_for_status()
+    headers = {"If-None-Match": _adguard_cache["etag"]} if _adguard_cache["etag"] else None
+    async with s.get(arguments.urls.adguard_clients, headers=headers) as r:
+        if r.status == 304:
+            return _adguard_cache["clients"]
+        r.raise_for_status()
+        etag = r.headers.get("ETag")
+        raw = await r.read()
+    body_hash = hashlib.blake2b(raw).digest()
+    if body_hash == _adguard_cache["body_hash"]:
+        _adguard_cache["etag"] = etag
+        return _adguard_cache["clients"]
+    body = orjson.loads(raw)
     clients = dict()
-    if r.json()['clients'] is not None:
-        for client in r.json()['clients']:
-            mac = None
-            for item in client['ids']:
-                if len(item) == 17:
-                    mac = item
-            if mac is not None:
-                clients[mac] = client
+    for client in body.get('clients') or ():
+        # the MAC is normally the last id, so scan from the end
+        if mac := next((item for item in reversed(client['ids']) if _is_mac(item)), None):
+            client['_ids_set'] = frozenset(client['ids'])
+            clients[mac] = client
+    _adguard_cache.update(etag=etag, body_hash=body_hash, clients=clients)
     return clients
 
 
-def adguard_add_client(s: requests.Session, client, adguard_url):
+async def adguard_add_client(s: aiohttp.ClientSession, client, arguments):
     """
     POST request to create a NEW client. A Unifi OS client object/dict
     is required.
-    :param adguard_url: base-url for adguard
-    :param s:       requests.Session
+    :param arguments: argparse arguments
+    :param s:       aiohttp.ClientSession
     :param client:  unifi-os client-dict
     :return:        None
     """
     if client.get("name") is None:
-        print("[sync] Client {} needs to be named.".format(client["display_name"]))
+        log.warning("Client %s needs to be named.", client["display_name"])
     else:
-        print("[sync] Adding client {} to AdGuard".format(client["display_name"]))
+        log.debug("Adding client %s to AdGuard", client["display_name"])
         ip = client.get('fixed_ip') or client.get('ip')
         if not ip or not client.get('mac'):
-            print(f"Skipping {client.get('display_name', 'unknown')} due to missing IP or MAC")
+            log.warning("Skipping %s due to missing IP or MAC", client.get('display_name') or 'unknown')
             return
 
-        data = {
-            "name": client['name'],
-            "ids": [
-                ip,
-                client['mac']
-            ],
-            "use_global_settings": True,
-            # "filtering_enabled": True,
-            # "parental_enabled": True,
-            # "safebrowsing_enabled": True,
-            # "safe_search": {
-            #    "enabled": True,
-            #    "bing": True,
-            #    "duckduckgo": True,
-            #    "ecosia": True,
-            #    "google": True,
-            #    "pixabay": True,
-            #    "yandex": True,
-            #    "youtube": True
-            # },
-            "use_global_blocked_services": True,
-            "tags": [],
-        }
-        r = s.post("{}/control/clients/add".format(adguard_url), json=data)
-        r.raise_for_status()
+        data = _ADD_TMPL | {"name": client['name'], "ids": [ip, client['mac']]}
+        async with _post(s, arguments.urls.adguard_add, data) as r:
+            r.raise_for_status()
 
 
-def adguard_delete_all(s: requests.Session, clients: list[str], adguard_url):
+async def adguard_delete_client(s: aiohttp.ClientSession, name, arguments):
     """
-    Used to clean up clients in AdGuard. Since AdGuard clients are merely names for existing
-    entities, deleting all doesn't remove any data. It just deletes the relationship between
-    IP-ADDR and a Name.
-    :param s:       requests.Session
-    :param clients: list of client names
-    :param adguard_url: base-url for adguard
-    :return:        None
+    POST request to delete a single client from AdGuard by name.
+    :param s:           aiohttp.ClientSession
+    :param name:        client name (from AdGuard client-dict)
+    :param arguments:   argparse arguments
+    :return:            None
     """
-    for c in clients:
-        r = s.post("{}/control/clients/delete".format(adguard_url), json={"name": c})
+    async with _post(s, arguments.urls.adguard_delete, {"name": name}) as r:
         r.raise_for_status()
 
 
-def adguard_update_client(s: requests.Session, client, old_name, adguard_url):
+async def adguard_update_client(s: aiohttp.ClientSession, client, old_name, arguments):
     """
     POST request to update a client. This request will update the name and
     IDS (mac_addr, ip_addr) of the client object in AdGuard.
-    :param s:           requests.Session
+    :param s:           aiohttp.ClientSession
     :param client:      unifi-os client-dict
     :param old_name:    the original name (from AdGuard client-dict)
-    :param adguard_url: base-url for adguard
+    :param arguments:   argparse arguments
     :return:            None
     """
-    print("[sync] Updating client {} in AdGuard".format(old_name))
+    log.debug("Updating client %s in AdGuard", old_name)
     ip = client.get('fixed_ip') or client.get('ip')
     data = {
         "name": old_name,
-        "data": {
-            "upstreams": [],
-            "tags": [],
-            "name": client['name'],
-            "blocked_services": None,
-            "ids": [
-                ip,
-                client['mac']
-            ],
-            "filtering_enabled": False,
-            "parental_enabled": False,
-            "safebrowsing_enabled": False,
-            "safesearch_enabled": False,
-            "use_global_blocked_services": True,
-            "use_global_settings": True
-        }
+        "data": _UPDATE_INNER_TMPL | {"name": client['name'], "ids": [ip, client['mac']]}
     }
-    r = s.post("{}/control/clients/update".format(adguard_url), json=data)
-    r.raise_for_status()
+    async with _post(s, arguments.urls.adguard_update, data) as r:
+        r.raise_for_status()
+
+
+async def adguard_bulk_apply(s: aiohttp.ClientSession, adds, updates, deletes, arguments):
+    """
+    Apply all pending AdGuard changes in a single burst. AdGuard has no multi-op
+    endpoint, so the requests are issued concurrently and run in parallel over the
+    session's pooled HTTP/1.1 keep-alive connections (up to limit_per_host).
+    Deletes go first: AdGuard rejects an add or rename whose name or id is still
+    held by a stale client.
+    :param s:           aiohttp.ClientSession
+    :param adds:        list of unifi-os client-dicts to add
+    :param updates:     list of (unifi-os client-dict, old_name) tuples to update
+    :param deletes:     list of AdGuard client names to delete
+    :param arguments:   argparse arguments
+    :return:            None
+    """
+    await asyncio.gather(*[adguard_delete_client(s, name, arguments) for name in deletes])
+    await asyncio.gather(*[adguard_add_client(s, client, arguments) for client in adds],
+                         *[adguard_update_client(s, client, old_name, arguments) for client, old_name in updates])
+
 
+def unifi_signature(unifi_clients: dict[str, dict], arguments) -> str:
+    """
+    Hash of everything the sync writes to AdGuard (mac, name, ip per client) plus the
+    AdGuard target and prune setting, so an unchanged Unifi snapshot can be detected without
+    contacting AdGuard.
+    :param unifi_clients: dict[str, dict] -> {mac_addr: client-obj}
+    :param arguments:     argparse arguments
+    :return:              hex digest
+    """
+    snapshot = sorted((m, c.get('name'), c.get('fixed_ip') or c.get('ip')) for m, c in unifi_clients.items())
+    return hashlib.blake2b(orjson.dumps([arguments.adguard_url, arguments.prune, snapshot])).hexdigest()
+
+
+def load_state(path) -> dict:
+    """
+    Read the state of the last successful sync. A missing or unreadable file is an empty state.
+    :param path: state file path
+    :return:     dict
+    """
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
 
-def main():
+
+def save_state(path, state: dict):
+    """
+    Atomically write the state of a successful sync (write to a temp file, then os.replace).
+    :param path:  state file path
+    :param state: JSON-serializable dict
+    :return:      None
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = "{}.tmp".format(path)
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(state))
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning("Could not save state to %s: %s", path, e)
+
+
+async def main():
     args = parse_args()
+    if args.loop or args.watch:
+        await run_forever(args)
+    else:
+        state = load_state(args.state_file)
+        # one session per host so neither blocks the other's connection pool
+        async with client_session() as unifi_session, client_session() as adguard_session:
+            await sync_once(state, unifi_session, adguard_session, args)
+
+
+async def run_forever(args):
+    """
+    Keep syncing with the same sessions and in-memory state. The next cycle starts
+    after --interval seconds, or with --watch once the Unifi event listener signals
+    a change (bursts of events are coalesced into one sync). Never returns.
+    :param args: argparse arguments
+    :return:     None
+    """
+    state = load_state(args.state_file)
+    trigger = asyncio.Event()
+    listener = asyncio.create_task(listen_unifi_events(args, trigger)) if args.watch else None
+    try:
+        async with client_session() as unifi_session, client_session() as adguard_session:
+            while True:
+                try:
+                    await sync_once(state, unifi_session, adguard_session, args)
+                except Exception as e:
+                    # keep running; the next cycle retries
+                    log.error("Sync failed: %s", e)
+                if listener is None:
+                    await asyncio.sleep(args.interval)
+                else:
+                    listener = await wait_for_trigger(args, trigger, listener)
+                    await asyncio.sleep(SYNC_DEBOUNCE)
+                    trigger.clear()
+    finally:
+        if listener is not None:
+            listener.cancel()
+
+
+async def wait_for_trigger(args, trigger: asyncio.Event, listener: asyncio.Task) -> asyncio.Task:
+    """
+    Wait until `trigger` is set. If the event listener task dies in the meantime it is
+    logged and restarted, so watch mode never waits on a listener that is gone.
+    :param args:     argparse arguments
+    :param trigger:  asyncio.Event set by listen_unifi_events()
+    :param listener: running listen_unifi_events() task
+    :return:         the listener task, restarted if it had stopped
+    """
+    while not trigger.is_set():
+        waiter = asyncio.create_task(trigger.wait())
+        try:
+            done, _ = await asyncio.wait({waiter, listener}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if listener in done:
+            # %s, not %r: the repr of aiohttp errors includes request headers with the login cookie
+            e = listener.exception()
+            watch_log.error("Unifi event listener stopped (%s: %s), restarting", type(e).__name__, e)
+            listener = asyncio.create_task(listen_unifi_events(args, trigger))
+    return listener
+
+
+async def listen_unifi_events(args, trigger: asyncio.Event):
+    """
+    Keep a Unifi event websocket open and set `trigger` for client events. While the
+    websocket is down, set `trigger` every `args.interval` seconds instead (polling fallback).
+    :param args:    argparse arguments
+    :param trigger: asyncio.Event awaited by wait_for_trigger()
+    :return:        None
+    """
+    while True:
+        try:
+            async with client_session() as session:
+                await unifi_login(session, args)
+                watch_log.info("Listening for Unifi client events...")
+                flush_logs()
+                async for event in unifi_event_stream(session, args):
+                    meta = event.get("meta")
+                    if isinstance(meta, dict) and meta.get("message") in UNIFI_SYNC_EVENTS:
+                        trigger.set()
+            watch_log.warning("Unifi event stream closed")
+        except Exception as e:
+            # any failure (network, timeout, unexpected payload) falls through to polling and reconnecting
+            # %s, not %r: the repr of aiohttp errors includes request headers with the login cookie
+            watch_log.warning("Unifi event stream failed: %s: %s", type(e).__name__, e)
+        # poll until the event stream is back
+        await asyncio.sleep(args.interval)
+        trigger.set()
+
+
+async def sync_once(state: dict, unifi_session: aiohttp.ClientSession, adguard_session: aiohttp.ClientSession, args):
+    """
+    One sync cycle: retrieve clients from both sides, then dispatch all AdGuard changes concurrently.
+    :param state:           in-memory sync state, updated (and flushed to disk) when it changes
+    :param unifi_session:   aiohttp.ClientSession used for Unifi
+    :param adguard_session: aiohttp.ClientSession used for AdGuard
+    :param args:            argparse arguments
+    :return:                None
+    """
     start_ts = datetime.now(tz=timezone.utc)
-    print(f"[sync] Start cycle at {start_ts}")
-    # create session
-    session = requests.Session()
+    log.info("Start cycle at %s", start_ts)
+    await sync_clients(state, unifi_session, adguard_session, args)
+    end_ts = datetime.now(tz=timezone.utc)
+    log.info("End cycle at %s", end_ts)
+    flush_logs()
 
-    # login to unifi and retrieve clients
-    unifi_login(session, args)
-    print("[sync] Retrieving active clients from Unifi...")
-    unifi_clients = unifi_get_active_clients(session, args)
 
-    # login to adguard and retrieve clients
-    adguard_login(session, args)
-    print("[sync] Retrieving clients from AdGuard...")
-    adguard_clients = adguard_get_clients(session, args)
+async def fetch_unifi(s: aiohttp.ClientSession, args) -> dict[str, dict]:
+    """
+    Login to Unifi and retrieve its active clients.
+    :param s:    aiohttp.ClientSession
+    :param args: argparse arguments
+    :return:     dict[str, dict] -> {mac_addr: client-obj}
+    """
+    await unifi_login(s, args)
+    log.info("Retrieving active clients from Unifi...")
+    return await unifi_get_active_clients(s, args)
+
+
+async def fetch_adguard(s: aiohttp.ClientSession, args) -> dict[str, dict]:
+    """
+    Login to AdGuard and retrieve its clients.
+    :param s:    aiohttp.ClientSession
+    :param args: argparse arguments
+    :return:     dict[str, dict] -> {mac_addr: client-obj}
+    """
+    await adguard_login(s, args)
+    log.info("Retrieving clients from AdGuard...")
+    return await adguard_get_clients(s, args)
+
+
+async def sync_clients(state: dict, unifi_session: aiohttp.ClientSession, adguard_session: aiohttp.ClientSession,
+                       args):
+    """
+    Retrieve clients from both sides, then dispatch all AdGuard changes concurrently.
+    :param state:           in-memory sync state, updated (and flushed to disk) when it changes
+    :param unifi_session:   aiohttp.ClientSession used for Unifi
+    :param adguard_session: aiohttp.ClientSession used for AdGuard
+    :param args:            argparse arguments
+    :return:                None
+    """
+    if "sig" not in state:
+        # nothing to compare against, so AdGuard is needed anyway: retrieve both concurrently
+        unifi_clients, adguard_clients = await asyncio.gather(fetch_unifi(unifi_session, args),
+                                                              fetch_adguard(adguard_session, args))
+        sig = unifi_signature(unifi_clients, args)
+    else:
+        # skip AdGuard entirely if Unifi is unchanged since the last successful sync
+        unifi_clients = await fetch_unifi(unifi_session, args)
+        sig = unifi_signature(unifi_clients, args)
+        if sig == state["sig"]:
+            log.info("Unifi clients unchanged since last sync, no changes required.")
+            return
+        adguard_clients = await fetch_adguard(adguard_session, args)
 
     # determine changes
-    print("[sync] Calculating changes...")
-    unifi_active_client_macs = set(list(unifi_clients.keys()))
-    adguard_client_macs = set(list(adguard_clients.keys()))
-    new_clients = unifi_active_client_macs - adguard_client_macs
-    existing_clients = unifi_active_client_macs.intersection(adguard_client_macs)
+    log.info("Calculating changes...")
+    new_clients = unifi_clients.keys() - adguard_clients.keys()
+    existing_clients = unifi_clients.keys() & adguard_clients.keys()
+    stale_clients = adguard_clients.keys() - unifi_clients.keys() if args.prune else set()
     modified_clients = 0
 
     # make changes if necessary
-    if len(new_clients) > 0:
-        for c in new_clients:
-            adguard_add_client(session, unifi_clients[c], args.adguard_url)
-    if len(existing_clients) > 0:
-        for c in existing_clients:
-            ip = unifi_clients[c].get('fixed_ip') or unifi_clients[c].get('ip')
-            unifi_data = {ip, unifi_clients[c]['mac']}
-            if (unifi_data != set(adguard_clients[c]['ids'])) or unifi_clients[c]['name'] != adguard_clients[c]['name']:
-                modified_clients += 1
-                print(f"[sync] Differences found for client {unifi_clients[c]['name']}, updating...")
-                adguard_update_client(session, unifi_clients[c], adguard_clients[c]['name'], args.adguard_url)
-                adguard_update_client(session, unifi_clients[c], adguard_clients[c]['name'], args.adguard_url)
-    if len(new_clients) == 0 and modified_clients == 0:
-        print("[sync] No changes required.")
+    updates = []
+    for c in existing_clients:
+        u = unifi_clients[c]
+        a = adguard_clients[c]
+        if u['name'] is None:
+            log.warning("Client %s needs to be named.", u["display_name"])
+            continue
+        ip = u.get('fixed_ip') or u.get('ip')
+        if frozenset((ip, u['mac'])) != a['_ids_set'] or u['name'] != a['name']:
+            modified_clients += 1
+            log.debug("Differences found for client %s, updating...", u['name'])
+            updates.append((u, a['name']))
+    # a sudden drop in active Unifi clients (controller restarting, bad response) must not wipe AdGuard
+    prune_refused = False
+    if stale_clients and not unifi_clients:
+        log.warning("Unifi returned no active clients, not pruning %d AdGuard clients.", len(stale_clients))
+        prune_refused = True
+    elif len(stale_clients) > PRUNE_MAX_FRACTION * len(adguard_clients):
+        log.warning("Pruning would remove %d of %d AdGuard clients, more than %d%%; not pruning.",
+                    len(stale_clients), len(adguard_clients), PRUNE_MAX_FRACTION * 100)
+        prune_refused = True
+    deletes = [] if prune_refused else [adguard_clients[c]['name'] for c in stale_clients]
+    for name in deletes:
+        log.debug("Removing stale client %s from AdGuard", name)
+    await adguard_bulk_apply(adguard_session, [unifi_clients[c] for c in new_clients], updates, deletes, args)
+    # a refused prune is re-checked next cycle instead of being hidden behind an unchanged signature
+    if not prune_refused:
+        state["sig"] = sig
+        save_state(args.state_file, state)
+    if len(new_clients) == 0 and modified_clients == 0 and len(deletes) == 0:
+        log.info("No changes required.")
     else:
-        print("[sync] Changes made: {} added, {} modified.".format(len(new_clients), modified_clients))
-    end_ts = datetime.now(tz=timezone.utc)
-    print(f"[sync] End cycle at {end_ts}")
+        log.info("Changes made: %d added, %d modified, %d removed.", len(new_clients), modified_clients, len(deletes))
 
 
 if __name__ == '__main__':
+    setup_logging()
     try:
-        main()
+        asyncio.run(main())
     except Exception as e:
         # avoid crashing container; log and continue
-        print(f"[sync] Sync failed: {e}")
+        log.error("Sync failed: %s", e)
+    finally:
+        logging.shutdown()